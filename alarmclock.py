@@ -2,18 +2,94 @@
 
 import os
 import argparse
+import array
+import asyncio
+import hashlib
+import struct
 import time
 import logging
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 from datetime import datetime as dt
 from datetime import timedelta as td
+from datetime import timezone
 
-from gpiozero import OutputDevice, Button
+from gpiozero import DigitalOutputDevice, Button
 import icalendar
 import recurring_ical_events
-import urllib.request
+import httplib2
 from dotenv import load_dotenv
 import humanize
-import pytz
+
+
+# Last downloaded calendar and the conditional request headers built from the
+# validators the server sent with it, so an unchanged ICS is answered with a
+# 304 instead of being parsed again. The recurring_ical_events query is kept
+# with it so its parsed components are reused by every between() call until
+# the calendar changes.
+ical_cache = {
+  'headers': {},
+  'calendar': None,
+  'ev_index': None,
+}
+
+# Shared keep-alive client so each refresh reuses the open TCP/TLS connection.
+http = httplib2.Http(timeout=30)
+
+# update_events() always runs on this one worker thread, which keeps the
+# download and recurrence expansion off the event loop and means the
+# httplib2 client and ical_cache are never touched from two threads at once.
+refresh_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='refresh')
+
+# Start/end epoch seconds of one event, as fed to the schedule hash.
+interval_struct = struct.Struct('<qq')
+
+# The fields of a calendar event the rest of the script uses, copied out of
+# the icalendar component once per refresh.
+Alarm = namedtuple('Alarm', 'start end summary')
+
+
+def fetch_calendar(url):
+  logging.debug('Executing fetch_calendar()')
+  try:
+    response, ical_string = http.request(url, 'GET', headers=ical_cache['headers'])
+  except Exception as e:
+    logging.error(f'Failed to download ICS: {e}')
+    return ical_cache['calendar'], ical_cache['ev_index']
+
+  if response.status == 304:
+    logging.debug('ICS not modified, reusing cached calendar')
+    return ical_cache['calendar'], ical_cache['ev_index']
+  if response.status != 200:
+    logging.error(f'Failed to download ICS: HTTP {response.status}')
+    return ical_cache['calendar'], ical_cache['ev_index']
+
+  headers = {}
+  if response.get('etag'):
+    headers['If-None-Match'] = response['etag']
+  if response.get('last-modified'):
+    headers['If-Modified-Since'] = response['last-modified']
+
+  # Drop the raw body as soon as it is parsed so it is not held alongside the
+  # component tree while the recurrence query is built.
+  calendar = icalendar.Calendar.from_ical(ical_string)
+  del ical_string
+
+  ical_cache['headers'] = headers
+  ical_cache['calendar'] = calendar
+  ical_cache['ev_index'] = recurring_ical_events.of(calendar)
+
+  return ical_cache['calendar'], ical_cache['ev_index']
+
+
+def to_timestamp(value):
+  # All-day events have a date rather than a datetime; treat them as starting
+  # at local midnight. Naive datetimes are taken as local time.
+  if not isinstance(value, dt):
+    value = dt.combine(value, dt.min.time())
+  return value.timestamp()
 
 
 def update_events(url=None):
@@ -22,33 +98,48 @@ def update_events(url=None):
     logging.error('updated_events() did not receive `url` (None)')
     return None
 
-  sleep_time = int(os.getenv('ALARMCLOCK_REFRESH_FREQUENCY', 300))
-  events = ''
-
-  while len(events) < 1:
+  # No calendar or an empty week is not retried here; the next scheduled
+  # refresh tries again while the alarm loop keeps running.
+  events = []
+  calendar, ev_index = fetch_calendar(url)
+  if calendar is None:
+    logging.debug('No calendar available.')
+  else:
     start_date = dt.now()
-    end_date = dt.now() + td(days=7)
-
-    try:
-      ical_string = urllib.request.urlopen(url).read()
-    except:
-      pass
-
-    calendar = icalendar.Calendar.from_ical(ical_string)
-    events = recurring_ical_events.of(calendar).between(start_date, end_date)
-    events.sort(key=lambda date: date["DTSTART"].dt)
-    
+    end_date = start_date + td(days=7)
+    events = ev_index.between(start_date, end_date)
     if len(events) < 1:
-      logging.debug(f'No events found. Sleeping for {sleep_time} seconds.')
-      time.sleep(sleep_time)
+      logging.debug('No events found.')
 
-  event_str = ''
-  for event in events:
-    event_str = event_str + str(event["DTSTART"].dt) + str(event["DTEND"].dt)
+  # Convert each event's times once and sort on the epoch start, so one pass
+  # below yields the sorted events, the lookup arrays and the hash.
+  alarms = (
+    Alarm(event["DTSTART"].dt, event["DTEND"].dt, str(event.get("SUMMARY", "")))
+    for event in events
+  )
+  timed = sorted(
+    ((int(to_timestamp(alarm.start)), int(to_timestamp(alarm.end)), alarm) for alarm in alarms),
+    key=itemgetter(0),
+  )
+
+  # Start/end epoch seconds for alarm_active(), kept as two int64 arrays.
+  # ends[i] holds the latest end of events[0..i] so an alarm overlapped by a
+  # later, shorter one is still seen. The hash of the raw times tells the
+  # caller whether the schedule changed.
+  events = []
+  starts = array.array('q')
+  ends = array.array('q')
+  packed = bytearray()
+  for start, end, alarm in timed:
+    events.append(alarm)
+    packed += interval_struct.pack(start, end)
+    starts.append(start)
+    ends.append(max(end, ends[-1]) if ends else end)
+  intervals = (starts, ends)
 
-  event_hash = hash(event_str)
+  event_hash = hashlib.blake2b(packed, digest_size=16).digest()
 
-  return calendar, events, event_hash
+  return calendar, events, intervals, event_hash
 
 
 def show_summary(events=None):
@@ -56,25 +147,118 @@ def show_summary(events=None):
   if events == None:
     logging.error('show_summary() did not receive `events` (None')
 
-  now = dt.utcnow().replace(tzinfo=pytz.utc)
+  # Everything below only feeds logging.info(), so skip it when INFO is off.
+  if not logging.getLogger().isEnabledFor(logging.INFO):
+    return
+
+  now = dt.now(timezone.utc)
 
   for event in events:
-    start = event["DTSTART"].dt
-    end = event["DTEND"].dt
+    start = event.start
+    end = event.end
     duration = end - start
-    p_start = humanize.precisedelta(now - start)
-    p_end = humanize.precisedelta(now - end)
-    summary = event["SUMMARY"]
+    summary = event.summary
 
     if start < now:
+        p_end = humanize.precisedelta(now - end)
         logging.info(f"Alarm[{summary}] has been active since {start} | duration {duration} | ends: {p_end}")
     else:
+        p_start = humanize.precisedelta(now - start)
         logging.info(f"Alarm[{summary}] starts at {start} ({p_start}) | duration {duration}")
 
 
-if __name__ == "__main__":
-  logging.debug("Starting core code...")
+def alarm_active(intervals, now):
+  starts, ends = intervals
+  i = bisect_right(starts, now)
+  return i > 0 and ends[i - 1] > now
+
+
+def shake(relay):
+  # Pulse the shaker one second on, three seconds off until relay.off().
+  logging.debug('relay.blink()')
+  relay.blink(on_time=1, off_time=3)
+
+
+async def refresh(url, state):
+  loop = asyncio.get_running_loop()
+  async with state['lock']:
+    calendar, events, intervals, new_event_hash = await loop.run_in_executor(
+      refresh_executor, update_events, url
+    )
+    state['events'] = events
+    state['intervals'] = intervals
+    state['last_refresh'] = time.monotonic()
+    if new_event_hash != state['event_hash']:
+      show_summary(events)
+      state['event_hash'] = new_event_hash
+
 
+async def refresh_loop(url, refresh_frequency, state):
+  # Measured on the monotonic clock so NTP steps or DST changes cannot delay
+  # or bunch up refreshes. A refresh done when an alarm ends restarts the wait.
+  while True:
+    delay = state['last_refresh'] + refresh_frequency - time.monotonic()
+    if delay > 0:
+      await asyncio.sleep(delay)
+      continue
+    await refresh(url, state)
+
+
+async def alarm_loop(url, state, with_gpio, relay=None, sensor=None):
+  while True:
+    if alarm_active(state['intervals'], time.time()):
+      logging.info('Starting alarm')
+      show_summary(state['events'])
+      if with_gpio:
+        # gpiozero calls these from its edge-detection thread, so the shaker
+        # follows the bed sensor without this loop polling it.
+        sensor.when_pressed = lambda: shake(relay)
+        sensor.when_released = relay.off
+        if sensor.is_pressed:
+          shake(relay)
+      else:
+        logging.debug("Triggering alarm")
+
+      while alarm_active(state['intervals'], time.time()):
+        await asyncio.sleep(1)
+
+      if with_gpio:
+        sensor.when_pressed = None
+        sensor.when_released = None
+        logging.debug('relay.off()')
+        relay.off()
+
+      logging.info('Ending alarm')
+      await refresh(url, state)
+
+      show_summary(state['events'])
+
+    await asyncio.sleep(1)
+
+
+async def run(url, refresh_frequency, with_gpio, relay=None, sensor=None):
+  loop = asyncio.get_running_loop()
+  calendar, events, intervals, event_hash = await loop.run_in_executor(
+    refresh_executor, update_events, url
+  )
+  state = {
+    'events': events,
+    'intervals': intervals,
+    'event_hash': event_hash,
+    'last_refresh': time.monotonic(),
+    'lock': asyncio.Lock(),
+  }
+
+  show_summary(events)
+
+  logging.debug('Starting loop')
+  await asyncio.gather(
+    refresh_loop(url, refresh_frequency, state),
+    alarm_loop(url, state, with_gpio, relay, sensor),
+  )
+
+
+def main(argv=None):
   load_dotenv()
 
   next_alarm = 0
@@ -94,13 +278,10 @@ if __name__ == "__main__":
       help="Format of console log messages. See https://docs.python.org/3.7/library/logging.html#formatter-objects "
       "and https://docs.python.org/3.7/library/logging.html#logrecord-attributes",
   )
-  args = parser.parse_args()
-
-  # This seems to solve a bug
-  for handler in logging.root.handlers[:]:
-      logging.root.removeHandler(handler)
+  args = parser.parse_args(argv)
 
   logging.basicConfig(format=args.log_format, level=args.log_level)
+  logging.debug("Starting core code...")
   logging.debug(f"args: {args}")
 
   if args.log_level == "DEBUG":
@@ -114,7 +295,7 @@ if __name__ == "__main__":
   url = os.getenv('ALARMCLOCK_URL')
   relay_pin = os.getenv('ALARMCLOCK_RELAY_PIN', 4)
   sensor_pin = os.getenv('ALARMCLOCK_SENSOR_PIN', 17)
-  refresh_frequency = os.getenv('ALARMCLOCK_REFRESH_FREQUENCY', 300)
+  refresh_frequency = int(os.getenv('ALARMCLOCK_REFRESH_FREQUENCY', 300))
   
   if os.getenv('ALARMCLOCK_NO_GPIO'):
     with_gpio = False
@@ -127,9 +308,12 @@ if __name__ == "__main__":
   logging.debug(f"ALARMCLOCK_REFRESH_FREQUENCY: {refresh_frequency}")
   logging.debug(f"with_gpio (opposite ALARMCLOCK_NO_GPIO): {with_gpio}")
 
+  relay = None
+  sensor = None
+
   # Set up relay to activate shaker.
   if with_gpio:
-    relay = OutputDevice(
+    relay = DigitalOutputDevice(
         int(relay_pin), active_high=True, initial_value=False
     )
 
@@ -138,45 +322,9 @@ if __name__ == "__main__":
         pin=int(sensor_pin), hold_time=1, hold_repeat=True
     )
 
-  calendar, events, event_hash = update_events(url)
-  last_update_time = time.time()
-
-  show_summary(events)
-
-  logging.debug('Starting loop')
-  while True:
-    if int(time.time()) > (int(last_update_time) + int(refresh_frequency)):
-      calendar, events, new_event_hash = update_events(url)
-      last_update_time = time.time()
-      if new_event_hash != event_hash:
-        show_summary(events)
-        event_hash = new_event_hash
-
-    if len(recurring_ical_events.of(calendar).at(dt.now())) > 0:
-      logging.info('Starting alarm')
-      show_summary(events)
-      while len(recurring_ical_events.of(calendar).at(dt.now())) > 0:
-        if with_gpio: 
-          if sensor.is_pressed:
-            logging.debug("relay.on()")
-            relay.on()
-            time.sleep(1)
-          if relay.is_active:
-            logging.debug('relay.off()')
-            relay.off()
-            time.sleep(3)
-        else:
-          logging.debug("Triggering alarm")
-          while len(recurring_ical_events.of(calendar).at(dt.now())) > 0:
-            time.sleep(1)
 
-      logging.info('Ending alarm')
-      calendar, events, new_event_hash = update_events(url)
-      last_update_time = time.time()
-      if new_event_hash != event_hash:
-        show_summary(events)
-        event_hash = new_event_hash
+  asyncio.run(run(url, refresh_frequency, with_gpio, relay, sensor))
 
-      show_summary(events)
 
-    time.sleep(1)
+if __name__ == "__main__":
+  main()